@@ -25,6 +25,15 @@ def setup():
 
 embeddings = setup()
 
+# maximum number of answers
+MAX_ANSWERS = 50
+
+# results are cached per query and number of answers, so that only the requested answers are searched
+# while going back to a previous query or slider value does not search again
+@st.cache_data(ttl=3600, max_entries=1024)
+def search(query: str, top_k: int):
+    return embeddings.search(embeddings.encoder.encode([query])[0], top_k=top_k)
+
 st.title("👋 Welcome to the Gossip Search Engine")
 
 st.write("Type in any query to get relevant gossip articles. Try 'Angelina Jolie et Brad Pitt sont-ils toujours ensemble?' for instance 👀")
@@ -33,12 +42,11 @@ st.text_input("Your query:", key="query")
 
 st.slider("How many answers would you like?",
             min_value=1,
-            max_value=50,
+            max_value=MAX_ANSWERS,
             key="nb_answers")
 
 if st.session_state.query != "":
-    df_res = DataFrame(embeddings.search(embeddings.encoder.encode([st.session_state.query])[0],
-                                            top_k=st.session_state.nb_answers),
+    df_res = DataFrame(search(st.session_state.query, st.session_state.nb_answers),
                         columns=["Date", "Article", "Article Relevance Score", "Most relevant sentence", "Sentence Relevance Score"])
     st.dataframe(df_res, column_order="")
 
@@ -1,36 +1,65 @@
-from bs4 import BeautifulSoup
+from lxml import etree
+from io import BytesIO
 from typing import List
+import re
 from time import time
 import csv
-from urllib.request import urlopen
+from fetch import fetch, fetch_all
 
 
 def get_links_from_url(url: str,
                         tag_name: str,
                         url_tag_name: str,
-                        L_keyword: List[str]=[""],
-                        parser: str="xml") -> List[str]:
+                        L_keyword: List[str]=[""]) -> List[str]:
     '''
     Extract list of URLs from a given URL.
 
     Args:
         url: URL to get the forward links from.
+        tag_name: tag name of the elements containing the forward links.
+        url_tag_name: tag name of the forward link inside each element.
         keyword: keyword filtering of the forward links URLs; 'None' for no filtering.
-        parser: HTML parser.
 
     Returns:
         L_res: list of forward links from the given URL.
     '''
 
+    return get_links_from_content(fetch(url), tag_name, url_tag_name, L_keyword)
+
+
+def get_links_from_content(content: bytes,
+                            tag_name: str,
+                            url_tag_name: str,
+                            L_keyword: List[str]=[""]) -> List[str]:
+    '''
+    Extract list of URLs from an XML document.
+    The XML document is parsed as a stream, each tag being freed once its URL is read.
+
+    Args:
+        content: raw XML document.
+        tag_name: tag name of the elements containing the forward links.
+        url_tag_name: tag name of the forward link inside each element.
+        keyword: keyword filtering of the forward links URLs; 'None' for no filtering.
+
+    Returns:
+        L_res: list of forward links from the XML document.
+    '''
+
     L_res = []
-    with urlopen(url) as response: 
-        soup = BeautifulSoup(response, parser)
-        for tag in soup.find_all(tag_name):
-            content = tag.find_next(url_tag_name).text
-            for keyword in L_keyword:
-                if keyword in content:
-                    L_res.append(content)
-                    break
+    # an empty keyword matches every URL: skip the filtering, else match all the keywords in a single regex scan
+    if "" in L_keyword:
+        keyword_re = None
+    else:
+        keyword_re = re.compile("|".join(re.escape(keyword) for keyword in L_keyword))
+    # sitemaps are namespaced: match the tags whatever their namespace
+    for _, elem in etree.iterparse(BytesIO(content), tag=f"{{*}}{tag_name}"):
+        link = elem.findtext(f"{{*}}{url_tag_name}")
+        if link is not None and (keyword_re is None or keyword_re.search(link) is not None):
+            L_res.append(link)
+        # free the parsed elements to keep memory flat on large sitemaps
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
     return L_res
 
 
@@ -44,7 +73,7 @@ class ArticlesCrawler():
         xml_tag_names: tag name of the URLs in the sitemaps
         url_tag_name: tag name of the content in the tags
         L_keyword: list of keyword to filter out the sitemaps; a list with an empty string for no filtering
-        parser: URL parser 
+        max_workers: maximum number of sitemaps fetched concurrently
     '''
 
     def __init__(self, 
@@ -53,7 +82,7 @@ class ArticlesCrawler():
                 xml_tag_name: str="url", 
                 url_tag_name: str="loc", 
                 L_keyword: List[str]=[""], 
-                parser: str="xml"):
+                max_workers: int=32):
         '''
         Initializes attributes.
         '''
@@ -63,7 +92,7 @@ class ArticlesCrawler():
         self.xml_tag_name = xml_tag_name
         self.url_tag_name = url_tag_name
         self.L_keyword = L_keyword
-        self.parser = parser
+        self.max_workers = max_workers
 
 
     def crawl(self) -> List[str]:
@@ -79,12 +108,13 @@ class ArticlesCrawler():
                                         tag_name=self.sitemap_tag_name, 
                                         url_tag_name=self.url_tag_name, 
                                         L_keyword=self.L_keyword)
-        # get list of articles from each sitemap
+        # get list of articles from each sitemap, fetching the sitemaps concurrently on the event loop
         L_articles = []
-        for sitemap in L_sitemap:
-            urls = get_links_from_url(url=sitemap, 
-                                        tag_name=self.xml_tag_name, 
-                                        url_tag_name=self.url_tag_name)
+        L_content = fetch_all(L_sitemap, max_connections=self.max_workers)
+        for sitemap, content in zip(L_sitemap, L_content):
+            urls = get_links_from_content(content=content,
+                                            tag_name=self.xml_tag_name,
+                                            url_tag_name=self.url_tag_name)
             L_articles += urls
             print(f"\tsitemap: {sitemap}, {len(urls)} URLs")
         print("Total number of articles:", len(L_articles))
@@ -105,11 +135,9 @@ class ArticlesCrawler():
         L_articles = self.crawl()
         # save list of articles in csv format
         print("Saving articles to", file_name)
-        f = open(file_name, write_mode)
-        writer = csv.writer(f)
-        for url in L_articles:
-            writer.writerow([url])
-        f.close()
+        with open(file_name, write_mode) as f:
+            writer = csv.writer(f)
+            writer.writerows([url] for url in L_articles)
 
 def main():
     
@@ -1,16 +1,37 @@
 from qdrant_client import QdrantClient
 from qdrant_client.models import Distance, VectorParams
-from qdrant_client.models import PointStruct, Batch
+from qdrant_client.models import Filter, FieldCondition, MatchValue, SearchRequest, PayloadSchemaType
+from qdrant_client.models import ScalarQuantization, ScalarQuantizationConfig, ScalarType, SearchParams, QuantizationSearchParams
+from qdrant_client.models import HnswConfigDiff, OptimizersConfigDiff
 from scrap import ArticleScrapper
 from encode import Encoder
 from time import time
-from typing import List
-from sklearn.neighbors import NearestNeighbors
+from typing import List, Iterator, Tuple
+from uuid import uuid5, NAMESPACE_URL
+from collections import deque, OrderedDict
+from itertools import islice
+import numpy as np
 import csv
 from os.path import isfile
-from urllib.error import URLError
+from requests import RequestException
 from dotenv import load_dotenv
 from os import getenv
+import json
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+
+# vectors are compared in int8 (kept in RAM), the best candidates being rescored with the original vectors
+QUANTIZATION_CONFIG = ScalarQuantization(scalar=ScalarQuantizationConfig(type=ScalarType.INT8,
+                                                                            always_ram=True))
+# HNSW graph built in RAM; indexing starts once a segment holds 20k vectors
+HNSW_CONFIG = HnswConfigDiff(m=16,
+                                ef_construct=128,
+                                on_disk=False)
+OPTIMIZERS_CONFIG = OptimizersConfigDiff(indexing_threshold=20000)
+SEARCH_PARAMS = SearchParams(hnsw_ef=64,
+                                quantization=QuantizationSearchParams(rescore=True,
+                                                                        oversampling=2.0))
 
 
 class Embeddings:
@@ -21,13 +42,16 @@ class Embeddings:
         scrapper: ArticleScrapper object to retrieve the article contents from the URLs
         encoder: ArticleEncoder object to encode the article contents
         collection_name: collection name in Qdrant
+        sentence_collection_name: name of the Qdrant collection containing the embeddings of the article sentences
         qdrant_client: Qdrant client to access the database
+        sentence_embeddings_cache: LRU cache of the sentences and sentence embeddings of the articles, by URL
+        sentence_embeddings_cache_size: maximum number of articles in the cache
     '''
 
 
-    def __init__(self, qdrant_url: str, api_key: str, collection_name: str, scrapper: ArticleScrapper, encoder: Encoder):
+    def __init__(self, qdrant_url: str, api_key: str, collection_name: str, scrapper: ArticleScrapper, encoder: Encoder, sentence_collection_name: str=None):
         '''
-        Initialize the attributes and create the collection in the Qdrant database.
+        Initialize the attributes and create the collections in the Qdrant database.
 
         Parameters:
             qdrant_url: URL of the Qdrant database
@@ -35,21 +59,83 @@ class Embeddings:
             collection_name: name of the collection in Qdrant
             scrapper: ArticleScrapper object
             encoder: Encoder object
+            sentence_collection_name: name of the sentence collection in Qdrant; None for '<collection_name>_sentences'
         '''
 
         self.scrapper = scrapper
         self.encoder = encoder
         self.collection_name = collection_name
+        self.sentence_collection_name = sentence_collection_name if sentence_collection_name is not None else f"{collection_name}_sentences"
+        # the sentence embeddings of an article are computed once per URL
+        self.sentence_embeddings_cache = OrderedDict()
+        self.sentence_embeddings_cache_size = 1024
+        self.sentence_embeddings_cache_lock = Lock()
         self.qdrant_client = QdrantClient(url=qdrant_url,
-                                            api_key=api_key)
+                                            api_key=api_key,
+                                            prefer_grpc=True)
         if not self.qdrant_client.collection_exists(self.collection_name):
-            print("Creating collection:", self.collection_name)
-            self.qdrant_client.create_collection(collection_name=self.collection_name,
-                                vectors_config=VectorParams(size=384,
-                                                            distance=Distance.DOT))
+            self.create_collection(self.collection_name)
         else:
             print("Collection exists:", self.collection_name)
             print("Number of points in DB:", self.get_point_count())
+            self.update_collection_config(self.collection_name)
+        # articles are looked up by URL
+        if "url" not in self.qdrant_client.get_collection(self.collection_name).payload_schema:
+            self.qdrant_client.create_payload_index(collection_name=self.collection_name,
+                                                    field_name="url",
+                                                    field_schema=PayloadSchemaType.KEYWORD)
+        if not self.qdrant_client.collection_exists(self.sentence_collection_name):
+            self.create_collection(self.sentence_collection_name)
+            # sentences are looked up by article
+            self.qdrant_client.create_payload_index(collection_name=self.sentence_collection_name,
+                                                    field_name="article_id",
+                                                    field_schema=PayloadSchemaType.KEYWORD)
+        else:
+            self.update_collection_config(self.sentence_collection_name)
+
+
+    def create_collection(self, collection_name: str) -> None:
+        '''
+        Create a quantized HNSW-indexed collection in the Qdrant database.
+
+        Parameters:
+            collection_name: name of the collection
+        '''
+
+        print("Creating collection:", collection_name)
+        self.qdrant_client.create_collection(collection_name=collection_name,
+                            vectors_config=VectorParams(size=384,
+                                                        distance=Distance.DOT),
+                            hnsw_config=HNSW_CONFIG,
+                            optimizers_config=OPTIMIZERS_CONFIG,
+                            quantization_config=QUANTIZATION_CONFIG)
+
+
+    def update_collection_config(self, collection_name: str) -> None:
+        '''
+        Apply the quantization, HNSW and optimizer configurations to a collection created with other settings.
+        These configurations are otherwise only taken into account when a collection is created.
+
+        Parameters:
+            collection_name: name of the collection
+        '''
+
+        config = self.qdrant_client.get_collection(collection_name).config
+        # quantize collections created before quantization was enabled
+        if config.quantization_config is None:
+            print("Enabling quantization on collection:", collection_name)
+            self.qdrant_client.update_collection(collection_name=collection_name,
+                                                    quantization_config=QUANTIZATION_CONFIG)
+        # rebuild the HNSW graph of collections created with other index settings
+        hnsw_config = config.hnsw_config
+        if (hnsw_config.m != HNSW_CONFIG.m
+                or hnsw_config.ef_construct != HNSW_CONFIG.ef_construct
+                or bool(hnsw_config.on_disk) != HNSW_CONFIG.on_disk
+                or config.optimizer_config.indexing_threshold != OPTIMIZERS_CONFIG.indexing_threshold):
+            print("Updating HNSW and optimizers configuration of collection:", collection_name)
+            self.qdrant_client.update_collection(collection_name=collection_name,
+                                                    hnsw_config=HNSW_CONFIG,
+                                                    optimizers_config=OPTIMIZERS_CONFIG)
 
 
     def get_point_count(self) -> int:
@@ -59,34 +145,106 @@ class Embeddings:
 
         return (self.qdrant_client.count(self.collection_name, exact=True).count)
 
-    def get_non_inserted_articles_count(self, url_file_name: str) -> int:
+
+    def load_checkpoint(self, checkpoint_file_name: str, url_file_name: str) -> dict:
         '''
-        Get the number of files which were not inserted in the database.
+        Load the ingestion checkpoint, mapping each processed URL to its status ("done", "ignored" or "410").
+        The checkpoint is a JSON lines log with one record per processed URL, the last record of a URL winning.
+        If the checkpoint does not exist yet, it is initialized from the legacy ignored and 410 error files.
 
         Parameters:
-            url_file_name: name of the URL file
+            checkpoint_file_name: name of the checkpoint file
+            url_file_name: name of the URL file the checkpoint belongs to
+
+        Returns:
+            state: dictionary mapping the processed URLs to their status
+        '''
+
+        state = {}
+        if isfile(checkpoint_file_name):
+            line = "\n"
+            with open(checkpoint_file_name, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # last record cut by an interrupted run
+                        continue
+                    state[record.pop("url")] = record
+            # terminate a cut record so that the next records start on a new line
+            if not line.endswith("\n"):
+                with open(checkpoint_file_name, "a") as f:
+                    f.write("\n")
+            return state
+        print("Initializing checkpoint:", checkpoint_file_name)
+        # URLs recorded in the legacy ignored and 410 error files
+        url_file_name_prefix = url_file_name[:url_file_name.find('.')]
+        D_record = {}
+        for status, file_name in (("ignored", f"{url_file_name_prefix}_ignored.csv"),
+                                    ("410", f"{url_file_name_prefix}_http_error_410.csv")):
+            if isfile(file_name):
+                with open(file_name, "r") as f:
+                    for row in csv.reader(f):
+                        if len(row) > 0:
+                            D_record[row[0]] = {"status": status}
+        with open(checkpoint_file_name, "a") as f:
+            self.append_checkpoint(state, D_record, f)
+        return state
+
+
+    def get_inserted_urls(self) -> set:
+        '''
+        Get the URLs of the articles already inserted in the database.
 
         Returns:
-            nb_not_inserted: the aforementioned count
-        '''
-
-        nb_not_inserted = 0
-        # count the number of files that were ignored because too long
-        url_file_name_ignored = f"{url_file_name[:url_file_name.find('.')]}_ignored.csv"
-        if isfile(url_file_name_ignored):
-            with open(url_file_name_ignored, "r") as f_ignored:
-                nb_ignored = len(f_ignored.readlines())
-                nb_not_inserted += nb_ignored
-                print("\tAccounting for the", nb_ignored, "ignored files")
-        # count the number of files whose resource is not accessible anymore (410 error)
-        url_file_410_error = f"{url_file_name[:url_file_name.find('.')]}_http_error_410.csv"
-        if isfile(url_file_410_error):
-            with open(url_file_410_error, "r") as f_410:
-                nb_410_error = len(f_410.readlines())
-                nb_not_inserted += nb_410_error
-                print("\tAccounting for the", nb_410_error, "410 error files")
-        # return the total count
-        return nb_not_inserted
+            S_url: set of the inserted URLs
+        '''
+
+        S_url = set()
+        next_offset = None
+        while True:
+            L_point, next_offset = self.qdrant_client.scroll(collection_name=self.collection_name,
+                                                                limit=1000,
+                                                                offset=next_offset,
+                                                                with_payload=["url"],
+                                                                with_vectors=False)
+            for point in L_point:
+                S_url.add(point.payload["url"])
+            if next_offset is None:
+                break
+        return S_url
+
+
+    def append_checkpoint(self, state: dict, D_record: dict, checkpoint_file) -> None:
+        '''
+        Record the status of processed URLs in the checkpoint.
+        The records are appended to the checkpoint log, so that saving costs the same whatever the number of URLs already processed.
+
+        Parameters:
+            state: dictionary mapping the processed URLs to their status
+            D_record: dictionary mapping the newly processed URLs to their status
+            checkpoint_file: checkpoint file opened in append mode
+        '''
+
+        state.update(D_record)
+        checkpoint_file.write("".join(json.dumps({"url": url, **record}) + "\n" for url, record in D_record.items()))
+        checkpoint_file.flush()
+
+
+    def update_checkpoint(self, state: dict, article_batch: tuple, checkpoint_file) -> None:
+        '''
+        Mark the articles of an inserted batch as done in the checkpoint.
+
+        Parameters:
+            state: dictionary mapping the processed URLs to their status
+            article_batch: (ids, vectors, payloads) of the inserted articles
+            checkpoint_file: checkpoint file opened in append mode
+        '''
+
+        L_id, _, L_payload = article_batch
+        self.append_checkpoint(state,
+                                {payload["url"]: {"status": "done", "id": point_id, "ts": time()} for point_id, payload in zip(L_id, L_payload)},
+                                checkpoint_file)
 
 
     def get_url_list(self, url_file_name: str,
@@ -114,124 +272,196 @@ class Embeddings:
                 print(f"{url_file_name}: getting URLs until #{nb_embeddings}")
             else:
                 print(f"{url_file_name}: getting all URLs")
+        # skip and slice the lines with islice rather than one readline call per line
+        start = offset if offset > 0 else 0
+        stop = start + nb_embeddings if nb_embeddings > 0 else None
         with open(url_file_name) as f:
-            L_url = []
-            # get the file pointer to the offset
-            if offset > 0:
-                # get the true offset
-                offset += self.get_non_inserted_articles_count(url_file_name)
-                for i in range(offset):
-                    line = f.readline()
-                    if line == "\n" or line == "":
-                        if verbose == True:
-                            print(f"\tReached end of file: URL #{i - 1}")
-                        return L_url
-            # get the right number of URLs
-            if nb_embeddings > 0:
-                for i in range(nb_embeddings):
-                    line = f.readline()
-                    if line == "\n" or line == "":
-                        if verbose:
-                            print(f"\tReached end of file: URL #{offset + i - 1 if offset > 0 else i - 1}")
-                        return L_url
-                    else:
-                        L_url.append(line)
-                return L_url
-            else:
-                return f.readlines()
+            L_url = [line for line in islice(f, start, stop) if line.strip() != ""]
+        if verbose == True and nb_embeddings > 0 and len(L_url) < nb_embeddings:
+            print(f"\tReached end of file: URL #{start + len(L_url) - 1}")
+        return L_url
+
+
+    def scrap_url(self, url: str) -> tuple:
+        '''
+        Scrap the text and the publishing date of the article located at the URL, catching request errors so that it can be mapped over a thread pool.
+
+        Parameters:
+            url: url of the article
+
+        Returns:
+            (url, article, date, err): the url, the article text and publishing date (None on failure, or None date if the article has none) and the caught error (None on success)
+        '''
+
+        try:
+            article, date = self.scrapper.scrap_all(url)
+            return url, article, date, None
+        except RequestException as err:
+            return url, None, None, err
+
+
+    def scrap_urls(self, L_url: List[str], executor: ThreadPoolExecutor, max_pending: int) -> Iterator[tuple]:
+        '''
+        Scrap the articles concurrently, yielding them in the order of the URLs.
+        At most max_pending articles are being scrapped or waiting to be consumed at any time.
+
+        Parameters:
+            L_url: list of article URLs
+            executor: thread pool scrapping the articles
+            max_pending: maximum number of articles scrapped ahead of the consumer
+
+        Returns:
+            iterator over the (url, article, date, err) tuples returned by scrap_url
+        '''
+
+        L_future = deque()
+        for url in L_url:
+            L_future.append(executor.submit(self.scrap_url, url))
+            if len(L_future) >= max_pending:
+                yield L_future.popleft().result()
+        while len(L_future) > 0:
+            yield L_future.popleft().result()
+
+
+    def encode_batch(self, L_id: List[str], L_article: List[str], L_payload: List[dict], batch_size: int=64) -> Tuple[tuple, tuple]:
+        '''
+        Encode a batch of articles and the sentences of these articles.
+
+        Parameters:
+            L_id: ids of the articles
+            L_article: article contents
+            L_payload: payloads of the articles
+            batch_size: batch size used by the language model
+
+        Returns:
+            (article_batch, sentence_batch): (ids, vectors, payloads) tuples of points to insert in the article and in the sentence collections
+        '''
+
+        vectors = self.encoder.encode(L_article, batch_size=batch_size)
+        L_sentence_id = []
+        L_sentence = []
+        L_sentence_payload = []
+        for article_id, article, payload in zip(L_id, L_article, L_payload):
+            for k, sentence in enumerate(self.encoder.get_sentences(article)):
+                # deterministic id so that re-inserting an article overwrites its sentences
+                L_sentence_id.append(str(uuid5(NAMESPACE_URL, f"{payload['url']}#{k}")))
+                L_sentence.append(sentence)
+                L_sentence_payload.append({"article_id": article_id, "sentence": sentence, "url": payload["url"]})
+        sentence_vectors = self.encoder.encode(L_sentence, batch_size=batch_size) if len(L_sentence) > 0 else None
+        return (L_id, vectors, L_payload), (L_sentence_id, sentence_vectors, L_sentence_payload)
+
+
+    def insert_batch(self, article_batch: tuple, sentence_batch: tuple, message: str=None) -> None:
+        '''
+        Insert a batch of article embeddings and the embeddings of their sentences into the database.
+        The vectors are sent as numpy arrays through gRPC.
+
+        Parameters:
+            article_batch: (ids, vectors, payloads) of the points to insert in the article collection
+            sentence_batch: (ids, vectors, payloads) of the points to insert in the sentence collection
+            message: message to display once the batch is inserted; None for no display
+        '''
+
+        for collection_name, (L_id, vectors, L_payload) in ((self.collection_name, article_batch),
+                                                            (self.sentence_collection_name, sentence_batch)):
+            if len(L_id) > 0:
+                self.qdrant_client.upload_collection(collection_name=collection_name,
+                                                        vectors=vectors,
+                                                        payload=L_payload,
+                                                        ids=L_id,
+                                                        batch_size=256,
+                                                        wait=True)
+        if message is not None:
+            print(message)
 
 
     def get_embeddings(self, url_file_name: str,
                                 offset: int=-1,
                                 nb_embeddings: int=-1,
                                 max_token: int=1200,
-                                batch_size_encode: int=5,
+                                batch_size_encode: int=64,
                                 batch_size_insert: int=100,
+                                max_workers: int=16,
+                                checkpoint_file_name: str=None,
                                 verbose: int=100) -> None:
         '''
-        Scrap the article contents from the URLs in the input file, encode the contents, insert the resulting embeddings in the database.
-        Work is done in batches.
+        Scrap the article contents from the URLs in the input file, encode the contents and their sentences, insert the resulting embeddings in the database.
+        Work is done in batches. The URLs already processed, as recorded in the checkpoint, are skipped, so that an interrupted run can be resumed.
 
         Parameters:
             url_file_name: file containing the list of article URLs
-            batch_size: batch size of the articles to process at once
+            offset: index of the first URL of the file to process; -1 or 0 means starting from the beginning
+            nb_embeddings: number of URLs of the file to process; -1 means all the URLs starting from the offset
+            max_token: maximum number of words of an article; longer articles are ignored
+            batch_size_encode: batch size used by the language model when encoding the articles
+            batch_size_insert: number of articles scrapped before being encoded and inserted at once
+            max_workers: number of threads scrapping the articles concurrently
+            checkpoint_file_name: file where the processed URLs are recorded; None for '<url_file_name>_checkpoint.jsonl'
             verbose: frequency of current state displaying (non-positive for no display)
         '''
 
-        assert batch_size_encode <= batch_size_insert and batch_size_insert % batch_size_encode == 0, "Encoding and Insertion batch sizes incompatible"
         start = time()
         scrapper = ArticleScrapper(paragraph_tag_name="p")
         i = 0
         L_article = []
         L_payload = []
-        L_vector = []
-        L_id = []
-        L_ignored = []
-        L_410_error = []
-        id_start = self.get_point_count()
-        with open(url_file_name) as url_file:
-            # get list of the article URLs
-            L_url = self.get_url_list(url_file_name, offset, nb_embeddings)
-            # scrap each URL, encode them in batches and insert them in batches into the database
-            for url in L_url:
-                url = url.rstrip()
-                # scrap each URL
-                try:
-                    article = self.scrapper.scrap(url)
-                    l = len(article.split(" "))
-#print(i,l, url)
+        if checkpoint_file_name is None:
+            checkpoint_file_name = f"{url_file_name[:url_file_name.find('.')]}_checkpoint.jsonl"
+        state = self.load_checkpoint(checkpoint_file_name, url_file_name)
+        # articles may have been inserted from another URL file: skip them without recording them in this file's checkpoint
+        S_seen_url = self.get_inserted_urls()
+        # the articles are scrapped by a thread pool, encoded by the current thread and inserted by a dedicated thread,
+        # so that scrapping, encoding and insertion overlap
+        with open(checkpoint_file_name, "a") as checkpoint_file, \
+                ThreadPoolExecutor(max_workers=max_workers) as executor, \
+                ThreadPoolExecutor(max_workers=1) as insert_executor:
+            insertion = None
+            # get list of the unique article URLs which were not processed yet
+            L_url = dict.fromkeys(url.rstrip() for url in self.get_url_list(url_file_name, offset, nb_embeddings))
+            L_url = [url for url in L_url if url not in state and url not in S_seen_url]
+            print(f"\t{url_file_name}: {len(L_url)} URLs to process")
+            # scrap the URLs concurrently, encode them in batches and insert them in batches into the database
+            for url, article, date, err in self.scrap_urls(L_url, executor, max_pending=2 * batch_size_insert):
+                if err is None:
                     if len(article.split(" ")) < max_token:
-                        L_article.append(self.scrapper.scrap(url))
-                        L_payload.append({"url": url})
+                        L_article.append(article)
+                        L_payload.append({"url": url, "date": date})
                         i += 1
                     else:
-                        L_ignored.append(url)
+                        self.append_checkpoint(state, {url: {"status": "ignored", "ts": time()}}, checkpoint_file)
+                        print("Article too long, ignored:", url)
                 # catch 410 errors
-                except URLError as err:
-                    if err.code == 410:
-                        L_410_error.append(url)
+                elif err.response is not None and err.response.status_code == 410:
+                    self.append_checkpoint(state, {url: {"status": "410", "ts": time()}}, checkpoint_file)
+                    print(f"\t{url}: error 410, ignored")
                 if verbose > 0 and i % verbose == 0:
-                    print(f"\t{url_file_name}: scrapped article: {i + offset if offset > -1 else i}, time elapsed: {round(time() - start, 1)} sec")
-                # encode article contents in batches
-                if i % batch_size_encode == 0 and len(L_article) > 0:
-                    L_vector += self.encoder.encode(L_article)
-                    L_id += range(i - batch_size_encode + 1 + id_start, i + 1 + id_start)
+                    print(f"\t{url_file_name}: scrapped article: {i}, time elapsed: {round(time() - start, 1)} sec")
+                # encode the article contents and insert the embeddings in batches into the database
+                if len(L_article) == batch_size_insert:
+                    # deterministic id so that runs on different URL files never collide
+                    L_id = [str(uuid5(NAMESPACE_URL, payload["url"])) for payload in L_payload]
+                    article_batch, sentence_batch = self.encode_batch(L_id, L_article, L_payload, batch_size=batch_size_encode)
+                    # wait for the previous insertion before sending the next one
+                    if insertion is not None:
+                        insertion.result()
+                        self.update_checkpoint(state, inserted_batch, checkpoint_file)
+                    insertion = insert_executor.submit(self.insert_batch, article_batch, sentence_batch,
+                                                        f"\t{url_file_name}: inserted article embedding: {i}")
+                    inserted_batch = article_batch
                     L_article = []
-                # insert batches of encodings in batches into the database
-                if i % batch_size_insert == 0 and len(L_vector) > 0:
-                    self.qdrant_client.upsert(collection_name=self.collection_name,
-                                                points=Batch(ids=L_id,
-                                                                vectors=L_vector,
-                                                                payloads=L_payload))
-                    print(f"\t{url_file_name}: inserted article embedding:", i + offset if offset > -1 else i)
-                    L_vector = []
-                    L_id = []
                     L_payload = []
-					# update the ignored files list
-                    if len(L_ignored) != 0:
-                        with open(f"{url_file_name[:url_file_name.find('.')]}_ignored.csv", "a") as f:
-                            writer = csv.writer(f)
-                            writer.writerow([url])
-                            print("Article too long, added to ignored articles file:", url)
-                        L_ignored = []
-					# update the 410 error files list
-                    if len(L_410_error) != 0:
-                        with open(f"{url_file_name[:url_file_name.find('.')]}_http_error_410.csv", "a") as f:
-                            writer = csv.writer(f)
-                            writer.writerow([url])
-                            print(f"\t{url}: error 410, added file to 410 error URL file")
-                        L_410_error = []
-        # encode remaining articles 
-        nb_insert = len(L_article)
-        if nb_insert != 0:
-            L_vector += self.encoder.encode(L_article)
-            L_id += range(i - nb_insert + 1 + id_start, i + 1 + id_start)
-        # insert remaining embeddings into the database
-        if len(L_vector) != 0:
-            self.qdrant_client.upsert(collection_name=self.collection_name,
-                                           points=Batch(ids=L_id,
-                                                            vectors=L_vector,
-                                                            payloads=L_payload))
+            # encode and insert remaining articles into the database
+            if len(L_article) != 0:
+                L_id = [str(uuid5(NAMESPACE_URL, payload["url"])) for payload in L_payload]
+                article_batch, sentence_batch = self.encode_batch(L_id, L_article, L_payload, batch_size=batch_size_encode)
+                if insertion is not None:
+                    insertion.result()
+                    self.update_checkpoint(state, inserted_batch, checkpoint_file)
+                insertion = insert_executor.submit(self.insert_batch, article_batch, sentence_batch)
+                inserted_batch = article_batch
+            if insertion is not None:
+                insertion.result()
+                self.update_checkpoint(state, inserted_batch, checkpoint_file)
         print("Done enconding articles from:", url_file_name)
     
 
@@ -249,23 +479,103 @@ class Embeddings:
 
         L_result_article = self.qdrant_client.search(collection_name=self.collection_name,
                                                         query_vector=query_vector,
-                                                        limit=top_k)
-        L_result_article = [(res.payload["url"], res.score) for res in L_result_article]
+                                                        limit=top_k,
+                                                        search_params=SEARCH_PARAMS)
+        if len(L_result_article) == 0:
+            return []
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        # search the closest sentence of each article among the sentences stored at insertion time
+        L_result_sentence = self.qdrant_client.search_batch(collection_name=self.sentence_collection_name,
+                                                                requests=[SearchRequest(vector=query_vector.tolist(),
+                                                                                        filter=Filter(must=[FieldCondition(key="article_id",
+                                                                                                                            match=MatchValue(value=str(res.id)))]),
+                                                                                        limit=1,
+                                                                                        params=SEARCH_PARAMS,
+                                                                                        with_payload=True)
+                                                                            for res in L_result_article])
+        L_url = [res.payload["url"] for res in L_result_article]
+        # articles inserted before the sentence collection existed: encode their sentences now
+        L_missing_url = [url for url, L_sentence_hit in zip(L_url, L_result_sentence) if len(L_sentence_hit) == 0]
+        # the date is stored with the article: only the articles inserted without it or without their sentences are scrapped,
+        # each page being downloaded and parsed once for both its text and its date;
+        # a page that cannot be downloaded leaves its date and sentence empty instead of failing the whole search
+        S_missing_url = set(L_missing_url)
+        L_scrap_url = [url for res, url in zip(L_result_article, L_url) if "date" not in res.payload or url in S_missing_url]
+        D_page = {}
+        if len(L_scrap_url) > 0:
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                D_page = {url: (article, date) for url, article, date, _ in executor.map(self.scrap_url, dict.fromkeys(L_scrap_url))}
+        L_date = [res.payload["date"] if "date" in res.payload else D_page[url][1] for res, url in zip(L_result_article, L_url)]
+        D_closest_sentence = self.get_closest_sentences({url: D_page[url][0] for url in L_missing_url if D_page[url][0] is not None}, query_vector)
         L_result = []
-        for (url, score) in L_result_article:
-            # get embeddings of each sentence from the article
-            article = self.scrapper.scrap(url=url)
-            L_sentences = self.encoder.get_sentences(article)
-            L_vectors = self.encoder.encode(L_sentences)
-            date = self.scrapper.scrap_date(url)
-            # search for sentence embedding in the article closest to the query vector
-            nn = NearestNeighbors(n_neighbors=1).fit(L_vectors)
-            sentence_score, indice = nn.kneighbors([query_vector])
-            L_result.append((date, url, score, L_sentences[int(indice[0][0])], float(sentence_score[0][0]))) 
+        for res, url, date, L_sentence_hit in zip(L_result_article, L_url, L_date, L_result_sentence):
+            if len(L_sentence_hit) > 0:
+                sentence, sentence_score = L_sentence_hit[0].payload["sentence"], L_sentence_hit[0].score
+            else:
+                sentence, sentence_score = D_closest_sentence.get(url, (None, None))
+            L_result.append((date, url, res.score, sentence, sentence_score))
         # return list of (date, url, url_score, sentence, sentence_score)
         return L_result
 
 
+    def get_sentence_embeddings(self, D_article: dict) -> dict:
+        '''
+        Encode the sentences of articles.
+        All the sentences are encoded at once. Results are cached by URL.
+
+        Parameters:
+            D_article: dictionary mapping the urls of the articles to their text
+
+        Returns:
+            D_sentence_embeddings: dictionary mapping each url to the sentences of the article and their embeddings
+        '''
+
+        D_sentence_embeddings = {}
+        with self.sentence_embeddings_cache_lock:
+            for url in D_article:
+                if url in self.sentence_embeddings_cache:
+                    self.sentence_embeddings_cache.move_to_end(url)
+                    D_sentence_embeddings[url] = self.sentence_embeddings_cache[url]
+        L_url = [url for url in D_article if url not in D_sentence_embeddings]
+        if len(L_url) == 0:
+            return D_sentence_embeddings
+        # encode the sentences of all the articles in a single call, then split the embeddings by article
+        L_L_sentences = [self.encoder.get_sentences(D_article[url]) for url in L_url]
+        L_sentences = [sentence for L_article_sentences in L_L_sentences for sentence in L_article_sentences]
+        vectors = self.encoder.encode(L_sentences)
+        L_offset = np.cumsum([0] + [len(L_article_sentences) for L_article_sentences in L_L_sentences])
+        with self.sentence_embeddings_cache_lock:
+            for k, url in enumerate(L_url):
+                D_sentence_embeddings[url] = (L_L_sentences[k], vectors[L_offset[k]:L_offset[k + 1]])
+                self.sentence_embeddings_cache[url] = D_sentence_embeddings[url]
+            while len(self.sentence_embeddings_cache) > self.sentence_embeddings_cache_size:
+                self.sentence_embeddings_cache.popitem(last=False)
+        return D_sentence_embeddings
+
+
+    def get_closest_sentences(self, D_article: dict, query_vector: np.ndarray) -> dict:
+        '''
+        Find the sentence of articles closest to the query vector.
+
+        Parameters:
+            D_article: dictionary mapping the urls of the articles to their text
+            query_vector: query vector to search the closest sentences
+
+        Returns:
+            D_closest_sentence: dictionary mapping each url to the closest sentence and its similarity score with the query vector; articles without sentences are left out
+        '''
+
+        D_closest_sentence = {}
+        for url, (L_sentences, L_vectors) in self.get_sentence_embeddings(D_article).items():
+            if len(L_sentences) == 0:
+                continue
+            # search for sentence embedding in the article closest to the query vector (embeddings are normalized: dot product is the cosine similarity)
+            L_sentence_score = L_vectors @ query_vector
+            indice = int(L_sentence_score.argmax())
+            D_closest_sentence[url] = (L_sentences[indice], float(L_sentence_score[indice]))
+        return D_closest_sentence
+
+
 def main():
     # get config from .env
     load_dotenv()
@@ -289,37 +599,18 @@ def main():
     '''
     '''
     embeddings.get_embeddings(url_file_name="data/sample_vsd.csv",
-                                batch_size_encode=5, batch_size_insert=100,
+                                batch_size_encode=64, batch_size_insert=100,
                                 verbose=5)
     '''
     public_articles_file = "data/public_articles.csv"
     vsd_articles_file = "data/vsd_articles.csv"
-    offset = embeddings.get_point_count()
     embeddings.get_embeddings(url_file_name=public_articles_file,
-                                offset=offset,
-                                nb_embeddings=-1,
-                                batch_size_encode=5,
+                                batch_size_encode=64,
                                 batch_size_insert=100,
                                 verbose=50)
-    offset = embeddings.get_point_count()
-    with open(public_articles_file, "r") as f:
-        reader = csv.reader(f)
-        nb_articles_public = len(list(reader))
-    public_ignored_file = f"{public_articles_file[:public_articles_file.find('.')]}_ignored.csv"
-    if isfile(public_ignored_file):
-        with open(public_ignored_file, "r") as f:
-            reader = csv.reader(f)
-            nb_articles_public -= len(list(reader))
-    public_410_file = f"{public_articles_file[:public_articles_file.find('.')]}_http_error_410.csv"
-    if isfile(public_ignored_file):
-        with open(public_410_file, "r") as f:
-            reader = csv.reader(f)
-            nb_articles_public -= len(list(reader))
     print("Encoding VSD articles...")
     embeddings.get_embeddings(url_file_name=vsd_articles_file,
-                                offset=offset - nb_articles_public,
-                                nb_embeddings=-1,
-                                batch_size_encode=5,
+                                batch_size_encode=64,
                                 batch_size_insert=100,
                                 verbose=50)
     '''
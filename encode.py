@@ -1,4 +1,6 @@
 from sentence_transformers import SentenceTransformer
+import torch
+import numpy as np
 from mistralai import Mistral
 from scrap import ArticleScrapper
 from typing import List
@@ -13,43 +15,59 @@ class Encoder:
     Attributes:
         model_name: language model name
         model: language model object
+        device: device running the language model ("cuda" or "cpu")
+        backend: inference backend of the language model ("torch" or "onnx")
         api_key: Mistral AI API key
         mistral_client: Mistral client object
+        sentence_tokenizer: tokenizer splitting texts into sentences
     '''
     
 
-    def __init__(self, api_key: str=None, model_name: str='sentence-transformers/all-MiniLM-L6-v2'):
+    def __init__(self, api_key: str=None, model_name: str='sentence-transformers/all-MiniLM-L6-v2', device: str=None, backend: str=None):
         '''
         Initalize attributes.
+        The local language model runs on the GPU in half precision when one is available,
+        else on the CPU through ONNX Runtime, whose fused graph is faster than eager PyTorch.
         '''
 
+        self.sentence_tokenizer = PunktSentenceTokenizer()
         if api_key is not None:
             self.model_name = 'mistral-embed'
             self.api_key = api_key
             self.mistral_client = Mistral(api_key=api_key)
         else:
             self.api_key = None
-            self.model = SentenceTransformer(model_name)
+            self.device = device if device is not None else ("cuda" if torch.cuda.is_available() else "cpu")
+            self.backend = backend if backend is not None else ("torch" if self.device == "cuda" else "onnx")
+            self.model = SentenceTransformer(model_name, device=self.device, backend=self.backend)
+            if self.device == "cuda" and self.backend == "torch":
+                self.model = self.model.half()
     
 
-    def encode(self, L_str: List[str]):
+    def encode(self, L_str: List[str], batch_size: int=64) -> np.ndarray:
         '''
         Encode the argument string using the language model.
 
         Parameter:
             L_str: list of strings to encode
+            batch_size: number of strings encoded at once by the local language model
 
         Returns:
-            embedding: numpy array containing the embedding
+            embedding: float32 numpy array containing one embedding per row
         '''
 
         if self.api_key is not None:
             response = self.mistral_client.embeddings.create(model=self.model_name,
                                                     inputs=L_str)
-            return [data.embedding for data in response.data]
+            return np.asarray([data.embedding for data in response.data], dtype=np.float32)
         else:
-            embedding = self.model.encode(L_str)
-            return embedding.tolist()
+            with torch.inference_mode():
+                embedding = self.model.encode(L_str,
+                                                batch_size=batch_size,
+                                                show_progress_bar=False,
+                                                convert_to_numpy=True,
+                                                normalize_embeddings=True)
+            return embedding.astype(np.float32, copy=False)
         
 
 
@@ -64,12 +82,11 @@ class Encoder:
             L_sentences: list of the sentences
         '''
 
-        tokenizer = PunktSentenceTokenizer()
-        L_sentences = tokenizer.tokenize(s)
+        L_sentences = self.sentence_tokenizer.tokenize(s)
         return L_sentences
 
 
-    def encode_sentences(self, s: str) -> List[List]:
+    def encode_sentences(self, s: str) -> np.ndarray:
         '''
         Encode the sentences of the input string.
 
@@ -0,0 +1,275 @@
+from threading import Lock, Semaphore
+from urllib.parse import urlparse
+from typing import List, Tuple
+from email.message import Message
+from time import monotonic
+import asyncio
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from aiohttp.resolver import AsyncResolver
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+try:
+    import aiodns
+except ImportError:
+    aiodns = None
+
+
+# maximum number of concurrent requests sent to a single host
+MAX_REQUESTS_PER_HOST = 4
+# number of seconds the aiohttp sessions keep a resolved host address
+DNS_CACHE_TTL = 300
+
+_D_host_semaphore = {}
+_host_semaphore_lock = Lock()
+
+# HTTP session shared by the crawler and the scrapper so that connections are kept alive across requests
+# requests and aiohttp both ask for gzip and deflate compressed responses, and for brotli when the brotli package is installed
+SESSION = Session()
+_adapter = HTTPAdapter(pool_connections=32,
+                        pool_maxsize=64,
+                        max_retries=Retry(total=3, backoff_factor=0.5))
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
+
+def get_host_semaphore(url: str) -> Semaphore:
+    '''
+    Get the semaphore capping the number of concurrent requests to the host of a URL.
+
+    Parameters:
+        url: URL that is about to be requested
+
+    Returns:
+        semaphore: semaphore shared by all the URLs of the same host
+    '''
+
+    host = urlparse(url).netloc
+    with _host_semaphore_lock:
+        if host not in _D_host_semaphore:
+            _D_host_semaphore[host] = Semaphore(MAX_REQUESTS_PER_HOST)
+        return _D_host_semaphore[host]
+
+
+def get_charset(content_type: str) -> str:
+    '''
+    Get the charset parameter of a Content-Type header.
+
+    Parameters:
+        content_type: value of the Content-Type header; 'None' if the response has none
+
+    Returns:
+        charset: charset given by the header; 'None' if it gives none
+    '''
+
+    if content_type is None:
+        return None
+    # requests falls back to ISO-8859-1 for text types without charset: read the parameter itself
+    message = Message()
+    message["content-type"] = content_type
+    return message.get_param("charset")
+
+
+def fetch_page(url: str, timeout: float=10) -> Tuple[bytes, str]:
+    '''
+    Download the content located at the URL through the shared session, along with the charset announced by the server.
+
+    Parameters:
+        url: URL to download
+        timeout: timeout of the request in seconds
+
+    Returns:
+        content: raw content of the response
+        charset: charset of the Content-Type header; 'None' if the header gives none
+
+    Raises:
+        requests.HTTPError: the server answered with an error status code
+    '''
+
+    with get_host_semaphore(url):
+        response = SESSION.get(url, timeout=timeout)
+    response.raise_for_status()
+    return response.content, get_charset(response.headers.get("content-type"))
+
+
+def fetch(url: str, timeout: float=10) -> bytes:
+    '''
+    Download the content located at the URL through the shared session.
+
+    Parameters:
+        url: URL to download
+        timeout: timeout of the request in seconds
+
+    Returns:
+        content: raw content of the response
+
+    Raises:
+        requests.HTTPError: the server answered with an error status code
+    '''
+
+    return fetch_page(url, timeout)[0]
+
+
+def run(coroutine):
+    '''
+    Run a coroutine to completion, on uvloop when it is installed, else on the default asyncio event loop.
+
+    Parameters:
+        coroutine: coroutine to run
+
+    Returns:
+        the result of the coroutine
+    '''
+
+    if uvloop is not None:
+        return uvloop.run(coroutine)
+    return asyncio.run(coroutine)
+
+
+class TokenBucket:
+    '''
+    Limit the rate of the requests sent to a host, allowing short bursts.
+    Meant to be shared by the coroutines of a single event loop.
+
+    Attributes:
+        rate: number of requests allowed per second
+        capacity: maximum number of requests sent in a burst
+        tokens: number of requests that can be sent right away
+        last_refill: time of the last refill of the tokens
+    '''
+
+    def __init__(self, rate: float, capacity: float):
+        '''
+        Initialize attributes.
+        '''
+
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = monotonic()
+
+
+    async def acquire(self):
+        '''
+        Wait until a request can be sent and consume its token.
+        '''
+
+        while True:
+            now = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def get_client_session(max_connections: int=100, timeout: float=10, max_connections_per_host: int=MAX_REQUESTS_PER_HOST) -> ClientSession:
+    '''
+    Create an aiohttp session capping the number of requests sent to the same host at once.
+    Must be called from a running event loop.
+
+    Parameters:
+        max_connections: maximum number of simultaneous connections
+        timeout: connection and read timeout of each request in seconds
+        max_connections_per_host: maximum number of simultaneous connections to the same host
+
+    Returns:
+        session: aiohttp session
+    '''
+
+    # resolve the hosts asynchronously with aiodns when it is installed, else in threads, and cache the addresses
+    connector = TCPConnector(limit=max_connections,
+                                limit_per_host=max_connections_per_host,
+                                resolver=AsyncResolver() if aiodns is not None else None,
+                                use_dns_cache=True,
+                                ttl_dns_cache=DNS_CACHE_TTL)
+    # no total timeout: requests waiting for a free connection to their host must not time out
+    session_timeout = ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+    return ClientSession(connector=connector, timeout=session_timeout)
+
+
+async def fetch_page_async(session: ClientSession, url: str, max_retries: int=0, backoff_factor: float=0.5) -> Tuple[bytes, str]:
+    '''
+    Download the content located at the URL through an aiohttp session, along with the charset announced by the server.
+    Rate limited (429) and server error (5xx) responses are retried with an exponential backoff.
+
+    Parameters:
+        session: aiohttp session
+        url: URL to download
+        max_retries: maximum number of retries
+        backoff_factor: delay before the first retry in seconds, doubled at each retry
+
+    Returns:
+        content: raw content of the response
+        charset: charset of the Content-Type header; 'None' if the header gives none
+
+    Raises:
+        aiohttp.ClientResponseError: the server answered with an error status code
+    '''
+
+    for attempt in range(max_retries + 1):
+        async with session.get(url) as response:
+            if attempt == max_retries or (response.status != 429 and response.status < 500):
+                response.raise_for_status()
+                return await response.read(), response.charset
+        await asyncio.sleep(backoff_factor * 2 ** attempt)
+
+
+async def fetch_async(session: ClientSession, url: str, max_retries: int=0, backoff_factor: float=0.5) -> bytes:
+    '''
+    Download the content located at the URL through an aiohttp session.
+    Rate limited (429) and server error (5xx) responses are retried with an exponential backoff.
+
+    Parameters:
+        session: aiohttp session
+        url: URL to download
+        max_retries: maximum number of retries
+        backoff_factor: delay before the first retry in seconds, doubled at each retry
+
+    Returns:
+        content: raw content of the response
+
+    Raises:
+        aiohttp.ClientResponseError: the server answered with an error status code
+    '''
+
+    return (await fetch_page_async(session, url, max_retries, backoff_factor))[0]
+
+
+async def fetch_all_async(L_url: List[str], max_connections: int=100, timeout: float=10) -> List[bytes]:
+    '''
+    Download the contents located at the URLs concurrently.
+    At most MAX_REQUESTS_PER_HOST requests are sent to the same host at once.
+
+    Parameters:
+        L_url: URLs to download
+        max_connections: maximum number of simultaneous connections
+        timeout: connection and read timeout of each request in seconds
+
+    Returns:
+        L_content: raw contents of the responses, in the order of the URLs
+    '''
+
+    async with get_client_session(max_connections, timeout) as session:
+        return await asyncio.gather(*(fetch_async(session, url) for url in L_url))
+
+
+def fetch_all(L_url: List[str], max_connections: int=100, timeout: float=10) -> List[bytes]:
+    '''
+    Download the contents located at the URLs concurrently, from synchronous code.
+
+    Parameters:
+        L_url: URLs to download
+        max_connections: maximum number of simultaneous connections
+        timeout: connection and read timeout of each request in seconds
+
+    Returns:
+        L_content: raw contents of the responses, in the order of the URLs
+    '''
+
+    return run(fetch_all_async(L_url, max_connections, timeout))
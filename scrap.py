@@ -1,11 +1,89 @@
-from bs4 import BeautifulSoup
-from typing import List
-from urllib.request import Request, urlopen
-import urllib.parse as urlparse
-from urllib.parse import urlencode
+from bs4 import BeautifulSoup, SoupStrainer
+from bs4.dammit import EncodingDetector
+from lxml import etree
+from io import BytesIO
+from typing import List, Callable, Tuple, Iterable
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlparse
+from functools import lru_cache
+import codecs
+from hashlib import sha256
+from fetch import SESSION, TokenBucket, fetch_page, fetch_page_async, get_client_session
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+try:
+    from diskcache import Cache
+except ImportError:
+    Cache = None
 #from dotenv import load_dotenv
 #from os import getenv
 
+# text of an element and its descendants, computed in C as lxml.html's text_content() does
+_text_content = etree.XPath("string()")
+
+
+def _get_encoding(html: bytes, charset: str=None) -> str:
+    '''
+    Get the encoding of an HTML document, so that the parsers decode it once without sniffing.
+    The charset of the Content-Type header comes first, then the charset declared by the document.
+    Without any, the document is taken as UTF-8 if it decodes as such, else as Windows-1252, a superset of latin-1.
+
+    Parameters:
+        html: raw HTML document
+        charset: charset of the Content-Type header of the response; 'None' if the header gives none
+
+    Returns:
+        encoding: normalized name of the encoding of the document
+    '''
+
+    for encoding in (charset, EncodingDetector.find_declared_encoding(html, is_html=True)):
+        if encoding is not None:
+            try:
+                return codecs.lookup(encoding).name
+            except LookupError:
+                pass
+    try:
+        html.decode("utf-8")
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "cp1252"
+
+
+def _parse_lexbor(html: bytes, charset: str=None) -> LexborHTMLParser:
+    '''
+    Parse an HTML document with selectolax's Lexbor parser, which expects UTF-8 input.
+
+    Parameters:
+        html: raw HTML document
+        charset: charset of the Content-Type header of the response; 'None' if the header gives none
+
+    Returns:
+        tree: parsed document
+    '''
+
+    encoding = _get_encoding(html, charset)
+    return LexborHTMLParser(html if encoding == "utf-8" else html.decode(encoding, errors="replace"))
+
+
+@lru_cache(maxsize=256)
+def _fetch(url: str) -> Tuple[bytes, str]:
+    '''
+    Download the content located at the URL, keeping the most recently requested pages in memory.
+
+    Parameters:
+        url: URL to download
+
+    Returns:
+        content: raw content of the response
+        charset: charset of the Content-Type header; 'None' if the header gives none
+    '''
+
+    return fetch_page(url)
+
+
 def remove_tags(s: str) -> str:
     '''
     Parse content retrieved from paragraph tag in an HTML document.
@@ -16,51 +94,240 @@ def remove_tags(s: str) -> str:
 
     Returns:
         res: the parsed string content of the paragraph tag
+
+    Raises:
+        ValueError: the string has a tag left unterminated
     '''
 
-    res = ""
-    i = 0
-    j = 0
-    size = len(s)
-    L = []
-    open_tag = False
-    while j < len(s):
-        if s[j] == "<":
-            open_tag = True
-            if i != j:
-                L.append(s[i:j])
-            j += 1
-            while j < size and s[j] != ">":
-                j += 1
-            if j < size and s[j] == ">":
-                open_tag = False
-                j += 1
-                i = j
-        else:
-            j += 1
-    if i != j:
-        L.append(s[i:j])
-    res = " ".join(L)
-    if open_tag == True:
-        print("Invalid HTML syntax.")
+    # most paragraphs hold no tag: only their whitespace is normalized
+    if "<" not in s:
+        return " ".join(s.split())
+    # each piece after a "<" starts with the rest of a tag, cut at its ">";
+    # a piece without ">" belongs to a tag running up to the next "<", unless it is the last one
+    L = s.split("<")
+    if ">" not in L[-1]:
+        raise ValueError("Invalid HTML syntax.")
+    for k in range(1, len(L)):
+        L[k] = L[k].partition(">")[2]
+    res = " ".join(" ".join(L).split())
     return res
 
+def _lexbor_text(html: bytes, paragraph_tag_name: str, charset: str=None, collect_time: bool=False) -> Tuple[str, str]:
+    '''
+    Get the text content, and optionally the publishing date, from an article HTML document with selectolax's Lexbor parser.
+
+    Parameters:
+        html: raw HTML document of the article
+        paragraph_tag_name: tag name of the paragraph element that contains the text
+        charset: charset of the Content-Type header of the response; 'None' if the header gives none
+        collect_time: whether to get the text of the first time element as well
+
+    Returns:
+        article: the article text
+        time: string containing the article publishing date; 'None' if it is not collected or the document has no time element
+    '''
+
+    tree = _parse_lexbor(html, charset)
+    article = " ".join(node.text(deep=True) for node in tree.css(paragraph_tag_name))
+    node = tree.css_first("time") if collect_time else None
+    return article, (node.text() if node is not None else None)
+
+
+def _iterparse_text(html: bytes, paragraph_tag_name: str, charset: str=None, collect_time: bool=False) -> Tuple[str, str]:
+    '''
+    Get the text content, and optionally the publishing date, from an article HTML document with lxml.
+    The document is parsed as a stream, each paragraph being freed once its text is read.
+
+    Parameters:
+        html: raw HTML document of the article
+        paragraph_tag_name: tag name of the paragraph element that contains the text
+        charset: charset of the Content-Type header of the response; 'None' if the header gives none
+        collect_time: whether to get the text of the first time element as well
+
+    Returns:
+        article: the article text
+        time: string containing the article publishing date; 'None' if it is not collected or the document has no time element
+    '''
+
+    tag_names = (paragraph_tag_name, "time") if collect_time else (paragraph_tag_name,)
+    L = []
+    # bind the lookups of the loop locally
+    append = L.append
+    text_content = _text_content
+    time = None
+    try:
+        for _, elem in etree.iterparse(BytesIO(html), tag=tag_names, html=True, recover=True, encoding=_get_encoding(html, charset)):
+            # a time element may sit inside a paragraph: it is freed along with the paragraph
+            if elem.tag == "time":
+                if time is None:
+                    time = text_content(elem)
+                continue
+            append(text_content(elem))
+            elem.clear()
+            parent = elem.getparent()
+            while elem.getprevious() is not None:
+                del parent[0]
+    except etree.XMLSyntaxError:
+        # raised even in recover mode when the document holds no element, e.g. an empty body
+        pass
+    return " ".join(L), time
+
+
+def _soup_text(html: bytes, paragraph_tag_name: str, parser: str, charset: str=None, collect_time: bool=False) -> Tuple[str, str]:
+    '''
+    Get the text content, and optionally the publishing date, from an article HTML document with BeautifulSoup.
+    Only the paragraph elements, and the time elements if collected, are built into the tree.
+
+    Parameters:
+        html: raw HTML document of the article
+        paragraph_tag_name: tag name of the paragraph element that contains the text
+        parser: parser used by BeautifulSoup
+        charset: charset of the Content-Type header of the response; 'None' if the header gives none
+        collect_time: whether to get the text of the first time element as well
+
+    Returns:
+        article: the article text
+        time: string containing the article publishing date; 'None' if it is not collected or the document has no time element
+    '''
+
+    strainer = SoupStrainer([paragraph_tag_name, "time"] if collect_time else paragraph_tag_name)
+    soup = BeautifulSoup(html, parser, parse_only=strainer, from_encoding=_get_encoding(html, charset))
+    article = " ".join(paragraph.text for paragraph in soup.find_all(paragraph_tag_name))
+    node = soup.find("time") if collect_time else None
+    return article, (node.text if node is not None else None)
+
+
+def _parse_html(html: bytes, paragraph_tag_name: str, parser: str, charset: str=None, collect_time: bool=True) -> Tuple[str, str]:
+    '''
+    Get the text content and the publishing date from an article HTML document in a single parse.
+    Defined at module level so that it can be sent to worker processes.
+
+    Parameters:
+        html: raw HTML document of the article
+        paragraph_tag_name: tag name of the paragraph element that contains the text
+        parser: webpage parser
+        charset: charset of the Content-Type header of the response; 'None' if the header gives none
+        collect_time: whether to get the publishing date as well
+
+    Returns:
+        article: the article text
+        time: string containing the article publishing date; 'None' if it is not collected or the document has no time element
+    '''
+
+    if parser == "lexbor":
+        return _lexbor_text(html, paragraph_tag_name, charset, collect_time)
+    if parser == "lxml":
+        return _iterparse_text(html, paragraph_tag_name, charset, collect_time)
+    return _soup_text(html, paragraph_tag_name, parser, charset, collect_time)
+
+
 class ArticleScrapper:
     '''
     Scrap article text.
 
     Attributes:
         paragraph_tag_name: tag name of the paragraph element that contains the text
-        parser: webpage parser
+        parser: webpage parser; "lexbor" parses with selectolax instead of BeautifulSoup
+        time_strainer: restricts the parsing to the time elements
+        time_xpath: compiled XPath selecting the time elements of a document
+        disk_cache: on-disk cache of the downloaded pages shared across runs; 'None' for no disk cache
     '''
 
-    def __init__(self, paragraph_tag_name: str="p", parser: str="lxml"):
+    def __init__(self, paragraph_tag_name: str="p", parser: str="lxml", cache_dir: str=None):
         '''
         Initialize attributes.
+
+        Parameters:
+            paragraph_tag_name: tag name of the paragraph element that contains the text
+            parser: webpage parser
+            cache_dir: directory of the on-disk page cache; 'None' to keep the pages in memory only
         '''
 
+        if parser == "lexbor" and LexborHTMLParser is None:
+            raise ImportError("selectolax is required by the lexbor parser")
+        if cache_dir is not None and Cache is None:
+            raise ImportError("diskcache is required by the on-disk page cache")
         self.paragraph_tag_name = paragraph_tag_name
         self.parser = parser
+        self.time_strainer = SoupStrainer("time")
+        self.time_xpath = etree.XPath("//time")
+        self.disk_cache = Cache(cache_dir) if cache_dir is not None else None
+
+
+    def _fetch(self, url: str) -> Tuple[bytes, str]:
+        '''
+        Download the page located at the URL, unless it is already cached in memory or on disk.
+
+        Parameters:
+            url: URL of the page
+
+        Returns:
+            html: raw HTML document of the page
+            charset: charset of the Content-Type header; 'None' if the header gives none
+        '''
+
+        if self.disk_cache is None:
+            return _fetch(url)
+        key = sha256(url.encode()).hexdigest()
+        page = self.disk_cache.get(key)
+        if page is None:
+            page = _fetch(url)
+            self.disk_cache.set(key, page)
+        return page
+
+
+    def _parse(self, html: bytes, charset: str=None) -> str:
+        '''
+        Get the text content from an article HTML document.
+
+        Parameters:
+            html: raw HTML document of the article
+            charset: charset of the Content-Type header of the response; 'None' if the header gives none
+
+        Returns:
+            article: the article text
+        '''
+
+        return _parse_html(html, self.paragraph_tag_name, self.parser, charset, collect_time=False)[0]
+
+
+    def _parse_date(self, html: bytes, charset: str=None) -> str:
+        '''
+        Get the publishing date from an article HTML document.
+
+        Parameters:
+            html: raw HTML document of the article
+            charset: charset of the Content-Type header of the response; 'None' if the header gives none
+
+        Returns:
+            time: string containing the article publishing date
+        '''
+
+        if self.parser == "lexbor":
+            return _parse_lexbor(html, charset).css_first("time").text()
+        if self.parser == "lxml":
+            encoding = _get_encoding(html, charset)
+            tree = etree.fromstring(html, etree.HTMLParser(encoding=encoding))
+            return _text_content(self.time_xpath(tree)[0])
+        soup = BeautifulSoup(html, self.parser, parse_only=self.time_strainer, from_encoding=_get_encoding(html, charset))
+        time = soup.find("time").text
+        return time
+
+
+    def _parse_all(self, html: bytes, charset: str=None) -> Tuple[str, str]:
+        '''
+        Get both the text content and the publishing date from an article HTML document in a single parse.
+
+        Parameters:
+            html: raw HTML document of the article
+            charset: charset of the Content-Type header of the response; 'None' if the header gives none
+
+        Returns:
+            article: the article text
+            time: string containing the article publishing date; 'None' if the document has no time element
+        '''
+
+        return _parse_html(html, self.paragraph_tag_name, self.parser, charset)
 
 
     def scrap(self, url: str) -> str:
@@ -74,14 +341,7 @@ class ArticleScrapper:
             article: the article text
         '''
 
-        with urlopen(url) as response:
-            soup = BeautifulSoup(response, self.parser)
-            L = []
-            empty = True
-            for paragraph in soup.find_all(self.paragraph_tag_name):
-                L.append(paragraph.text)
-            article = " ".join(L)
-        return article
+        return self._parse(*self._fetch(url))
 
 
     def scrap_date(self, url: str) -> str:
@@ -95,10 +355,125 @@ class ArticleScrapper:
             time: string containing the article publishing date
         '''
 
-        with urlopen(url) as response:
-            soup = BeautifulSoup(response, self.parser)
-            time = soup.find("time").text
-        return time
+        return self._parse_date(*self._fetch(url))
+
+
+    def scrap_all(self, url: str) -> Tuple[str, str]:
+        '''
+        Get both the text content and the publishing date of the article located at the URL, downloading and parsing it once.
+
+        Parameters:
+            url: url of the article
+
+        Returns:
+            article: the article text
+            time: string containing the article publishing date; 'None' if the article has no time element
+        '''
+
+        return self._parse_all(*self._fetch(url))
+
+
+    async def _scrap_many(self, L_url: List[str], parse: Callable[[bytes, str], str], concurrency: int) -> list:
+        '''
+        Download and parse the articles located at the URLs concurrently on the running event loop.
+
+        Parameters:
+            L_url: urls of the articles
+            parse: function extracting the result from the raw HTML document of an article and the charset of its response
+            concurrency: maximum number of simultaneous connections
+
+        Returns:
+            L_res: parsed result of each article, in the order of the URLs; the raised exception for the articles that failed
+        '''
+
+        async with get_client_session(max_connections=concurrency) as session:
+            async def scrap_one(url: str) -> str:
+                return parse(*await fetch_page_async(session, url))
+            return await asyncio.gather(*(scrap_one(url) for url in L_url), return_exceptions=True)
+
+
+    async def scrap_many(self, L_url: List[str], concurrency: int=64) -> list:
+        '''
+        Get the text content from the articles located at the URLs, downloading them concurrently.
+
+        Parameters:
+            L_url: urls of the articles
+            concurrency: maximum number of simultaneous connections
+
+        Returns:
+            L_article: text of each article, in the order of the URLs; the raised exception for the articles that failed
+        '''
+
+        return await self._scrap_many(L_url, self._parse, concurrency)
+
+
+    async def scrap_date_many(self, L_url: List[str], concurrency: int=64) -> list:
+        '''
+        Return the publishing dates of the articles located at the URLs, downloading them concurrently.
+
+        Parameters:
+            L_url: urls of the articles
+            concurrency: maximum number of simultaneous connections
+
+        Returns:
+            L_time: publishing date of each article, in the order of the URLs; the raised exception for the articles that failed
+        '''
+
+        return await self._scrap_many(L_url, self._parse_date, concurrency)
+
+
+    async def run(self,
+                    url_iter: Iterable[str],
+                    out_queue: asyncio.Queue,
+                    workers: int=128,
+                    max_connections_per_host: int=64,
+                    requests_per_second: float=20,
+                    max_retries: int=3,
+                    processes: int=None):
+        '''
+        Scrap a stream of articles with a fixed pool of worker coroutines fed by a bounded queue.
+        Each host is rate limited by its own token bucket, and rate limited or failing requests are retried with an exponential backoff.
+        The pages are parsed in a pool of processes so that parsing scales with the CPU cores and does not block the event loop.
+
+        Parameters:
+            url_iter: urls of the articles
+            out_queue: queue receiving a (url, article, time, err) tuple per URL, err being 'None' on success
+                        and article and time being 'None' on failure; a final 'None' signals the end of the stream
+            workers: number of worker coroutines, i.e. maximum number of articles being scrapped at once
+            max_connections_per_host: maximum number of simultaneous connections to the same host
+            requests_per_second: maximum number of requests sent to the same host per second
+            max_retries: maximum number of retries of a rate limited or failing request
+            processes: number of parsing processes; 'None' for one per CPU core
+        '''
+
+        url_queue = asyncio.Queue(maxsize=2 * workers)
+        D_bucket = {}
+        loop = asyncio.get_running_loop()
+
+        async def worker(session, pool):
+            while (url := await url_queue.get()) is not None:
+                host = urlparse(url).netloc
+                if host not in D_bucket:
+                    D_bucket[host] = TokenBucket(rate=requests_per_second, capacity=requests_per_second)
+                await D_bucket[host].acquire()
+                try:
+                    html, charset = await fetch_page_async(session, url, max_retries=max_retries)
+                    # at most one page per worker is waiting for the parsing processes
+                    article, time = await loop.run_in_executor(pool, _parse_html, html, self.paragraph_tag_name, self.parser, charset)
+                    await out_queue.put((url, article, time, None))
+                except Exception as err:
+                    await out_queue.put((url, None, None, err))
+
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            async with get_client_session(max_connections=workers, max_connections_per_host=max_connections_per_host) as session:
+                tasks = [asyncio.create_task(worker(session, pool)) for _ in range(workers)]
+                for url in url_iter:
+                    await url_queue.put(url)
+                # one end marker per worker
+                for _ in range(workers):
+                    await url_queue.put(None)
+                await asyncio.gather(*tasks)
+        await out_queue.put(None)
 
 
     def scrap_linkup(self, params: dict, headers: dict, url: str="https://api.linkup.so/v1/content") -> str:
@@ -114,26 +489,21 @@ class ArticleScrapper:
             Raw API response for the input article (for now)
         '''
         
-        url_parts = list(urlparse.urlparse(url))
-        query = urlparse.parse_qs(url_parts[4])
-        query.update(params)
-        url_parts[4] = urlencode(query)
-        url = urlparse.urlunparse(url_parts)
-        req = Request(url, headers=headers)
-        response = urlopen(req)
+        # the shared session keeps the connection to the API alive between calls
+        # the API fetches the page itself before answering: allow it more time than a direct download
+        response = SESSION.get(url, params=params, headers=headers, timeout=30)
+        response.raise_for_status()
         # needs parsing
-        return (response.read().decode(response.headers.get_content_charset()))       
+        return response.text
 
 
 def main():
     scrapper = ArticleScrapper(paragraph_tag_name="p")
     url_public = "https://www.public.fr/une-etude-revele-la-couleur-des-yeux-des-personnes-les-plus-intelligentes-mythe-ou-realite"
     url_vsd = "https://vsd.fr/73030-nous-on-savait-la-verite-kendji-girac-evoque-avec-emotion-sa-relation-actuelle-avec-sa-femme-soraya/"
-    article = scrapper.scrap(url=url_public)
-    date = scrapper.scrap_date(url=url_public)
+    article, date = scrapper.scrap_all(url=url_public)
     print(article, date)
-    article = scrapper.scrap(url=url_vsd)
-    date = scrapper.scrap_date(url=url_vsd)
+    article, date = scrapper.scrap_all(url=url_vsd)
     print(article, date)
 
     '''